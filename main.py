@@ -1,25 +1,52 @@
 import os
 from fastapi import FastAPI, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, StreamingResponse
-from pydantic import BaseModel
-from typing import List, Optional, AsyncGenerator
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel, TypeAdapter, ValidationError
+from typing import List, Optional, AsyncGenerator, Tuple
+from contextlib import aclosing, asynccontextmanager
+from collections import OrderedDict
 import json
+import orjson
 import uuid
 from datetime import datetime
+import anyio
 import asyncio
+import concurrent.futures
+import functools
+import threading
+import time
+import atexit
+import hashlib
+import queue
 import logging
-from logging.handlers import RotatingFileHandler
-from azure.ai.projects import AIProjectClient
-from azure.identity import ClientSecretCredential
-from azure.ai.agents.models import ListSortOrder
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from dotenv import load_dotenv
-import re
+
+try:
+    import tiktoken
+except ImportError:  # Optional: token counts fall back to a character heuristic
+    tiktoken = None
 
 # Load environment variables
 load_dotenv()
 
-# Configure logging to output to both console and daily log files
+# Maximum number of agent runs in flight at once, to respect Azure rate limits
+MAX_CONCURRENT_RUNS = int(os.getenv('MAX_CONCURRENT_RUNS', '8'))
+
+# Streamed text deltas are batched into one SSE frame until any limit is hit
+STREAM_BATCH_TOKENS = int(os.getenv('STREAM_BATCH_TOKENS', '8'))
+STREAM_BATCH_BYTES = int(os.getenv('STREAM_BATCH_BYTES', '512'))
+STREAM_BATCH_FLUSH = float(os.getenv('STREAM_BATCH_FLUSH_MS', '50')) / 1000
+
+# Session to thread cache limits (requests carrying an X-Session-Id header)
+SESSION_CACHE_SIZE = int(os.getenv('SESSION_CACHE_SIZE', '1024'))
+SESSION_TTL = float(os.getenv('SESSION_TTL_SEC', '3600'))
+
+# Configure logging to output to both console and daily log files.
+# Records are handed to a background QueueListener so request coroutines
+# never block on console or disk I/O.
 def setup_logging():
     # Create logs directory if it doesn't exist
     log_dir = "logs"
@@ -35,6 +62,7 @@ def setup_logging():
     
     # Clear any existing handlers
     logger.handlers.clear()
+    logger.propagate = False
     
     # Create formatter
     formatter = logging.Formatter(
@@ -46,7 +74,6 @@ def setup_logging():
     console_handler = logging.StreamHandler()
     console_handler.setLevel(log_level)
     console_handler.setFormatter(formatter)
-    logger.addHandler(console_handler)
     
     # File handler with daily rotation
     today = datetime.now().strftime('%Y-%m-%d')
@@ -59,68 +86,130 @@ def setup_logging():
     )
     file_handler.setLevel(log_level)
     file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
+    
+    # Only a non-blocking queue handler is attached to the logger; the listener
+    # thread formats records and writes them to the console and file handlers
+    log_queue = queue.Queue(-1)
+    logger.addHandler(QueueHandler(log_queue))
+    listener = QueueListener(log_queue, console_handler, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
     
     return logger
 
 logger = setup_logging()
 
-# Audit functionality
+# Audit functionality.
+# Audit records are queued on the request path and written to disk by a single
+# background task, so serialization and file I/O stay off the request coroutines.
+AUDIT_DIR = "audits"
+audit_queue: asyncio.Queue = asyncio.Queue(maxsize=1024)
+
+# Metadata shared by every audit record, computed once at import
+AUDIT_METADATA = {
+    "server_version": "1.0.0",
+    "audit_format_version": "1.0",
+    "environment": {
+        "python_version": f"{os.sys.version_info.major}.{os.sys.version_info.minor}.{os.sys.version_info.micro}",
+        "platform": os.name,
+        "working_directory": os.getcwd()
+    }
+}
+
 def save_audit_data(request_data, response_data, request_type="chat_completion"):
-    """Save complete request and response data to audit files"""
+    """Queue complete request and response data for the audit writer"""
+    # Generate unique id with a millisecond epoch timestamp
+    timestamp_ms = int(time.time() * 1000)
+    audit_id = f"{timestamp_ms}_{uuid.uuid4().hex[:8]}"
+
+    # Prepare audit data with metadata; the ISO timestamp is rendered by the writer
+    audit_data = {
+        "audit_id": audit_id,
+        "timestamp": timestamp_ms,
+        "request_type": request_type,
+        "request": request_data,
+        "response": response_data,
+        "metadata": AUDIT_METADATA
+    }
+
     try:
-        # Create audits directory if it doesn't exist
-        audit_dir = "audits"
-        os.makedirs(audit_dir, exist_ok=True)
-        
-        # Generate unique filename with timestamp
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')[:-3]  # microseconds to milliseconds
-        audit_id = f"{timestamp}_{uuid.uuid4().hex[:8]}"
-        
-        # Prepare audit data with metadata
-        audit_data = {
-            "audit_id": audit_id,
-            "timestamp": datetime.now().isoformat(),
-            "request_type": request_type,
-            "request": request_data,
-            "response": response_data,
-            "metadata": {
-                "server_version": "1.0.0",
-                "audit_format_version": "1.0",
-                "environment": {
-                    "python_version": f"{os.sys.version_info.major}.{os.sys.version_info.minor}.{os.sys.version_info.micro}",
-                    "platform": os.name,
-                    "working_directory": os.getcwd()
-                }
-            }
-        }
-        
-        # Save to JSON file
-        audit_file = os.path.join(audit_dir, f"audit_{audit_id}.json")
-        with open(audit_file, 'w', encoding='utf-8') as f:
-            json.dump(audit_data, f, indent=2, ensure_ascii=False, default=str)
-        
-        logger.info(f"Audit data saved to: {audit_file}")
-        return audit_id
-        
-    except Exception as e:
-        logger.error(f"Failed to save audit data: {e}")
+        audit_queue.put_nowait(audit_data)
+    except asyncio.QueueFull:
+        logger.error(f"Audit queue full, dropping audit record {audit_id}")
         return None
+    return audit_id
+
+def audit_default(obj):
+    """Serialize the few non-JSON types that can appear in audit records"""
+    if isinstance(obj, BaseModel):
+        return obj.model_dump(mode="json")
+    if isinstance(obj, (bytes, bytearray)):
+        return obj.decode("utf-8", errors="replace")
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+def write_audit_file(audit_data):
+    """Serialize one audit record and write it to the audits directory (blocking)"""
+    audit_data["timestamp"] = datetime.fromtimestamp(audit_data["timestamp"] / 1000).isoformat()
+
+    # Request/response bodies may arrive already serialized; embed them verbatim
+    for key in ("request", "response"):
+        if isinstance(audit_data[key], bytes):
+            audit_data[key] = orjson.Fragment(audit_data[key])
+
+    os.makedirs(AUDIT_DIR, exist_ok=True)
+    audit_file = os.path.join(AUDIT_DIR, f"audit_{audit_data['audit_id']}.json")
+    with open(audit_file, 'wb') as f:
+        f.write(orjson.dumps(audit_data, default=audit_default, option=orjson.OPT_NON_STR_KEYS))
+    return audit_file
+
+async def audit_writer():
+    """Drain the audit queue, writing each record from a worker thread"""
+    while True:
+        audit_data = await audit_queue.get()
+        try:
+            audit_file = await asyncio.to_thread(write_audit_file, audit_data)
+            logger.info(f"Audit data saved to: {audit_file}")
+        except Exception as e:
+            logger.error(f"Failed to save audit data: {e}")
+        finally:
+            audit_queue.task_done()
+
+# tiktoken encoder, built once at startup; None means the heuristic is used
+token_encoding = None
+
+def load_token_encoding():
+    """Build the tiktoken encoder (may download its BPE file), or keep the heuristic"""
+    global token_encoding
+    if tiktoken is None:
+        return
+    try:
+        token_encoding = tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.warning(f"tiktoken encoder unavailable, using character heuristic for usage: {e}")
+
+def count_tokens(text: Optional[str]) -> int:
+    """Approximate token count: exact with tiktoken, otherwise ~4 characters per token"""
+    if not text:
+        return 0
+    if token_encoding is not None:
+        return len(token_encoding.encode(text, disallowed_special=()))
+    return max(1, len(text) // 4)
 
 app = FastAPI(title="Foundry Agent OpenAI Compatibility Layer", version="1.0.0")
 
 # Add logging middleware
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
-    # Log request basics
-    logger.info(f"{request.method} {request.url.path}")
-    
-    # Process request
+    if not logger.isEnabledFor(logging.INFO):
+        return await call_next(request)
+
+    start = time.perf_counter()
     response = await call_next(request)
-    
-    # Log response status
-    logger.info(f"Response: {response.status_code}")
-    
+    duration_ms = (time.perf_counter() - start) * 1000
+
+    # One line per request; for streaming responses this covers time to headers
+    logger.info(f"{request.method} {request.url.path} -> {response.status_code} {duration_ms:.1f}ms")
+
     return response
 
 app.add_middleware(
@@ -147,15 +236,6 @@ class Choice(BaseModel):
     message: Message
     finish_reason: str
 
-class Delta(BaseModel):
-    role: Optional[str] = None
-    content: Optional[str] = None
-
-class StreamChoice(BaseModel):
-    index: int
-    delta: Delta
-    finish_reason: Optional[str] = None
-
 class Usage(BaseModel):
     prompt_tokens: int
     completion_tokens: int
@@ -169,12 +249,118 @@ class ChatCompletionResponse(BaseModel):
     choices: List[Choice]
     usage: Usage
 
-class ChatCompletionStreamResponse(BaseModel):
-    id: str
-    object: str = "chat.completion.chunk"
-    created: int
-    model: str
-    choices: List[StreamChoice]
+# Reused validator/serializer for chat completion requests and responses
+REQUEST_ADAPTER = TypeAdapter(ChatCompletionRequest)
+RESPONSE_ADAPTER = TypeAdapter(ChatCompletionResponse)
+
+# Static response headers; per-request values are merged in by the endpoint
+BASE_RESPONSE_HEADERS = {
+    "Content-Type": "application/json",
+    "openai-version": "2020-10-01",
+}
+
+STREAM_RESPONSE_HEADERS = {
+    "Content-Type": "text/event-stream",
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Headers": "*",
+    "Access-Control-Allow-Methods": "*",
+}
+
+# Server-sent event framing
+SSE_PREFIX = b"data: "
+SSE_SUFFIX = b"\n\n"
+SSE_DONE = b"data: [DONE]\n\n"
+
+def make_stream_chunk(request_id: str, created: int, model: str, delta: dict, finish_reason: Optional[str] = None) -> dict:
+    """Build an OpenAI chat.completion.chunk payload as a plain dict"""
+    return {
+        "id": request_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+    }
+
+class SessionThreadCache:
+    """LRU cache mapping client session ids to Foundry thread ids, with a TTL.
+
+    Each session also owns an asyncio.Lock; callers hold it while they look up
+    or create the thread and run the agent on it, since Azure rejects new
+    messages and runs while another run is active on the same thread. Entries
+    are pinned against eviction while any caller holds or waits for the lock.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        # session_id -> [thread_id or None, session lock, last used, pin count]
+        self._entries: "OrderedDict[str, list]" = OrderedDict()
+        self._lock = asyncio.Lock()
+
+    @asynccontextmanager
+    async def hold(self, session_id: str):
+        """Hold the session lock, keeping the entry pinned until the block exits"""
+        async with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                entry = [None, asyncio.Lock(), time.monotonic(), 0]
+                self._entries[session_id] = entry
+            entry[3] += 1
+            self._entries.move_to_end(session_id)
+            self._evict()
+        try:
+            async with entry[1]:
+                yield
+        finally:
+            # Plain decrement: no await, so it is atomic on the event loop
+            entry[3] -= 1
+
+    async def get(self, session_id: str) -> Optional[str]:
+        async with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None or entry[0] is None:
+                return None
+            now = time.monotonic()
+            if now - entry[2] > self.ttl:
+                entry[0] = None
+                return None
+            entry[2] = now
+            self._entries.move_to_end(session_id)
+            return entry[0]
+
+    async def put(self, session_id: str, thread_id: str):
+        async with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                entry = [thread_id, asyncio.Lock(), time.monotonic(), 0]
+                self._entries[session_id] = entry
+            else:
+                entry[0] = thread_id
+                entry[2] = time.monotonic()
+            self._entries.move_to_end(session_id)
+            self._evict()
+
+    def _evict(self):
+        # Drop least recently used sessions, skipping pinned ones; the most
+        # recently touched entry is never evicted
+        for session_id in list(self._entries)[:-1]:
+            if len(self._entries) <= self.max_size:
+                break
+            if not self._entries[session_id][3]:
+                del self._entries[session_id]
+
+def get_last_user_message(request: ChatCompletionRequest) -> str:
+    """Return the content of the last user message in the request"""
+    for msg in reversed(request.messages):
+        if msg.role == "user":
+            if msg.content:
+                return msg.content
+            break
+
+    logger.error("No user message found in request")
+    raise HTTPException(status_code=400, detail="No user message found")
 
 class FoundryAgentAdapter:
     def __init__(self):
@@ -198,6 +384,11 @@ class FoundryAgentAdapter:
             
             raise ValueError(f"Missing required environment variables: {', '.join(missing)}")
 
+        # Azure SDK modules are imported here rather than at module load, so only
+        # processes that actually build the adapter pay their import cost
+        from azure.ai.projects import AIProjectClient
+        from azure.identity import ClientSecretCredential
+
         # Initialize Azure credentials
         self.credential = ClientSecretCredential(
             tenant_id=tenant_id,
@@ -209,295 +400,463 @@ class FoundryAgentAdapter:
             endpoint=endpoint
         )
         self.agent = self.project.agents.get_agent(agent_id)
+        self.run_semaphore = asyncio.Semaphore(MAX_CONCURRENT_RUNS)
+        # Agent runs (polling or streaming) hold a thread for their whole duration,
+        # so they get their own pool, sized to the run semaphore, rather than
+        # starving the default executor used by to_thread and the audit writer
+        self.run_executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_RUNS, thread_name_prefix="agent-run")
+        self.thread_cache = SessionThreadCache(SESSION_CACHE_SIZE, SESSION_TTL)
+
+    @asynccontextmanager
+    async def session_thread(self, session_id: Optional[str] = None):
+        """Yield the thread for a session, reusing the cached one or creating it.
+
+        For a session the session lock is held until the block exits, so
+        concurrent requests on one session run one after another.
+        """
+        if not session_id:
+            thread = await asyncio.to_thread(self.project.agents.threads.create)
+            logger.info(f"Created thread: {thread.id}")
+            yield thread.id
+            return
 
-    async def create_streaming_response(self, request: ChatCompletionRequest) -> AsyncGenerator[str, None]:
-        """Create a streaming response in OpenAI format"""
+        async with self.thread_cache.hold(session_id):
+            thread_id = await self.thread_cache.get(session_id)
+            if thread_id:
+                logger.info(f"Reusing thread {thread_id} for session {session_id}")
+            else:
+                thread = await asyncio.to_thread(self.project.agents.threads.create)
+                thread_id = thread.id
+                logger.info(f"Created thread: {thread_id}")
+                await self.thread_cache.put(session_id, thread_id)
+            yield thread_id
+
+    async def create_streaming_response(self, request: ChatCompletionRequest, session_id: Optional[str] = None) -> AsyncGenerator[Tuple[str, Optional[dict]], None]:
+        """Create a streaming response in OpenAI format.
+
+        Yields ("chunk", payload) events with OpenAI chunk dicts and a final
+        ("done", None) event; SSE framing is left to the caller. A yielded
+        payload may be reused for the next event, so it must be consumed
+        before the generator is resumed.
+        """
         request_id = f"chatcmpl-{uuid.uuid4().hex[:29]}"
-        created = int(datetime.now().timestamp())
+        created = int(time.time())
 
         try:
-            # Get the response from Foundry Agent (non-streaming)
-            response = await self.create_chat_completion(request)
-            content = response.choices[0].message.content
-
-            # First chunk with role
-            first_chunk = ChatCompletionStreamResponse(
-                id=request_id,
-                created=created,
-                model=request.model,
-                choices=[
-                    StreamChoice(
-                        index=0,
-                        delta=Delta(role="assistant", content=""),
-                        finish_reason=None
-                    )
-                ]
-            )
-            yield f"data: {json.dumps(first_chunk.model_dump())}\n\n"
+            last_user_message = get_last_user_message(request)
+
+            async with self.session_thread(session_id) as thread_id, self.run_semaphore:
+                # Create message in thread
+                await asyncio.to_thread(
+                    self.project.agents.messages.create,
+                    thread_id=thread_id,
+                    role="user",
+                    content=last_user_message
+                )
 
-            # Stream content in small chunks while preserving whitespace and newlines
-            # Split by whitespace but keep the whitespace characters
-            tokens = re.split(r'(\s+)', content)
-            
-            for i, token in enumerate(tokens):
-                if token:  # Skip empty tokens
-                    chunk = ChatCompletionStreamResponse(
-                        id=request_id,
-                        created=created,
-                        model=request.model,
-                        choices=[
-                            StreamChoice(
-                                index=0,
-                                delta=Delta(content=token),
-                                finish_reason=None
-                            )
-                        ]
-                    )
-
-                    yield f"data: {json.dumps(chunk.model_dump())}\n\n"
-                    await asyncio.sleep(0.05)  # Small delay to simulate streaming
+                # First chunk with role
+                yield "chunk", make_stream_chunk(request_id, created, request.model, {"role": "assistant", "content": ""})
+
+                # Build the chunk shape once; only the delta content changes per token
+                delta = {"content": ""}
+                chunk = make_stream_chunk(request_id, created, request.model, delta)
+
+                # Forward text deltas from the agent run as they arrive; aclosing
+                # makes stream_run clean up before the session lock is released
+                async with aclosing(self.stream_run(thread_id)) as deltas:
+                    async for text in deltas:
+                        delta["content"] = text
+                        yield "chunk", chunk
 
             # Final chunk with finish_reason
-            final_chunk = ChatCompletionStreamResponse(
-                id=request_id,
-                created=created,
-                model=request.model,
-                choices=[
-                    StreamChoice(
-                        index=0,
-                        delta=Delta(),
-                        finish_reason="stop"
-                    )
-                ]
-            )
-            yield f"data: {json.dumps(final_chunk.model_dump())}\n\n"
+            yield "chunk", make_stream_chunk(request_id, created, request.model, {}, "stop")
 
             # End of stream marker
-            yield "data: [DONE]\n\n"
+            yield "done", None
 
         except Exception as e:
             logger.error(f"Error in streaming response: {e}")
             # Send error as stream
-            error_chunk = ChatCompletionStreamResponse(
-                id=request_id,
-                created=created,
-                model=request.model,
-                choices=[
-                    StreamChoice(
-                        index=0,
-                        delta=Delta(role="assistant", content=f"Error: {str(e)}"),
-                        finish_reason="stop"
-                    )
-                ]
+            yield "chunk", make_stream_chunk(
+                request_id, created, request.model,
+                {"role": "assistant", "content": f"Error: {str(e)}"}, "stop"
             )
-            yield f"data: {json.dumps(error_chunk.model_dump())}\n\n"
-            yield "data: [DONE]\n\n"
-
-    async def create_chat_completion(self, request: ChatCompletionRequest) -> ChatCompletionResponse:
+            yield "done", None
+
+    async def stream_run(self, thread_id: str) -> AsyncGenerator[str, None]:
+        """Run the agent on a thread and yield text deltas as they are received.
+
+        The synchronous SDK event stream is consumed in a worker thread that
+        hands deltas over through a size-1 queue, so receiving from Azure and
+        flushing to the client overlap while back-pressure is preserved.
+        Deltas are batched up to STREAM_BATCH_TOKENS / STREAM_BATCH_BYTES, and
+        a partial batch is flushed once it is STREAM_BATCH_FLUSH seconds old.
+        """
+        from azure.ai.agents.models import AgentStreamEvent, MessageDeltaChunk, ThreadRun
+
+        loop = asyncio.get_running_loop()
+        events: asyncio.Queue = asyncio.Queue(maxsize=1)
+        stop = threading.Event()
+        run_state = {"run_id": None, "cancel_requested": False}
+        run_state_lock = threading.Lock()
+
+        def cancel_run():
+            # Called from the consumer and the producer; only the first call cancels
+            with run_state_lock:
+                run_id = run_state["run_id"]
+                if run_id is None or run_state["cancel_requested"]:
+                    return
+                run_state["cancel_requested"] = True
+            try:
+                self.project.agents.runs.cancel(thread_id=thread_id, run_id=run_id)
+                logger.info(f"Cancelled abandoned run {run_id}")
+            except Exception as e:
+                logger.warning(f"Failed to cancel run {run_id}: {e}")
+
+        def put(item):
+            # Wait for queue space in short slices so an abandoned stream never
+            # leaves this thread blocked on a queue nobody reads anymore
+            if stop.is_set():
+                return
+            future = asyncio.run_coroutine_threadsafe(events.put(item), loop)
+            while True:
+                try:
+                    future.result(timeout=0.1)
+                    return
+                except concurrent.futures.TimeoutError:
+                    if stop.is_set():
+                        future.cancel()
+                        return
+
+        def produce():
+            try:
+                last_run = None
+                with self.project.agents.runs.stream(thread_id=thread_id, agent_id=self.agent.id) as stream:
+                    for event_type, event_data, _ in stream:
+                        if isinstance(event_data, ThreadRun):
+                            last_run = event_data
+                            with run_state_lock:
+                                run_state["run_id"] = event_data.id
+                        if stop.is_set():
+                            cancel_run()
+                            return
+                        if isinstance(event_data, MessageDeltaChunk):
+                            if event_data.text:
+                                put(("delta", event_data.text))
+                        elif event_type == AgentStreamEvent.ERROR:
+                            raise RuntimeError(f"Agent stream error: {event_data}")
+
+                # Anything but a completed run (failed, cancelled, expired,
+                # incomplete, or no final status at all) is reported as an error
+                if last_run is None or last_run.status != "completed":
+                    status = last_run.status if last_run is not None else "unknown"
+                    last_error = last_run.last_error if last_run is not None else None
+                    raise RuntimeError(f"Agent run ended with status {status}: {last_error}")
+                if not stop.is_set():
+                    put(("end", None))
+            except Exception as e:
+                if not stop.is_set():
+                    put(("error", e))
+
+        producer = loop.run_in_executor(self.run_executor, produce)
+        finished = False
+        pending = []
+        pending_bytes = 0
+        flush_at = 0.0
+        getter = None
         try:
-            logger.info(f"Processing chat completion request with {len(request.messages)} messages")
-
-            # Create thread
-            thread = self.project.agents.threads.create()
-            logger.info(f"Created thread: {thread.id}")
-
-            # Find the last user message
-            last_user_message = None
-            for msg in reversed(request.messages):
-                if msg.role == "user":
-                    last_user_message = msg.content
+            while True:
+                if getter is None:
+                    getter = asyncio.ensure_future(events.get())
+                if pending:
+                    # Wait without cancelling the getter, so no delta is lost on timeout
+                    done, _ = await asyncio.wait({getter}, timeout=max(0.0, flush_at - loop.time()))
+                    if not done:
+                        yield "".join(pending)
+                        pending.clear()
+                        pending_bytes = 0
+                        continue
+                kind, value = await getter
+                getter = None
+
+                if kind == "delta":
+                    if not pending:
+                        flush_at = loop.time() + STREAM_BATCH_FLUSH
+                    pending.append(value)
+                    pending_bytes += len(value.encode())
+                    if len(pending) >= STREAM_BATCH_TOKENS or pending_bytes >= STREAM_BATCH_BYTES:
+                        yield "".join(pending)
+                        pending.clear()
+                        pending_bytes = 0
+                else:
+                    finished = True
+                    if pending:
+                        yield "".join(pending)
+                    if kind == "error":
+                        raise value
                     break
+        finally:
+            if getter is not None:
+                getter.cancel()
+            # Let an abandoned producer finish its pending put and exit
+            stop.set()
+            while not events.empty():
+                events.get_nowait()
+            # Cancel a run the client walked away from and wait for the producer
+            # thread to exit, so the caller keeps the session lock and run slot
+            # until the thread and its executor worker are actually free again
+            with anyio.CancelScope(shield=True):
+                if not finished:
+                    await asyncio.to_thread(cancel_run)
+                await producer
+
+    def get_last_assistant_message(self, thread_id: str, run_id: str):
+        """Return the newest assistant message produced by a run, or None (blocking)"""
+        from azure.ai.agents.models import ListSortOrder
+
+        messages_pager = self.project.agents.messages.list(
+            thread_id=thread_id,
+            run_id=run_id,
+            order=ListSortOrder.DESCENDING,
+            limit=1
+        )
+        for message in messages_pager:
+            if message.role == "assistant":
+                return message
+        return None
+
+    async def create_chat_completion(self, request: ChatCompletionRequest, session_id: Optional[str] = None) -> ChatCompletionResponse:
+        logger.info(f"Processing chat completion request with {len(request.messages)} messages")
 
-            if not last_user_message:
-                logger.error("No user message found in request")
-                raise HTTPException(status_code=400, detail="No user message found")
+        last_user_message = get_last_user_message(request)
 
+        # The Azure SDK client is synchronous, so every call runs in a worker
+        # thread to keep the event loop free for other requests
+        async with self.session_thread(session_id) as thread_id, self.run_semaphore:
             # Create message in thread
-            message = self.project.agents.messages.create(
-                thread_id=thread.id,
+            await asyncio.to_thread(
+                self.project.agents.messages.create,
+                thread_id=thread_id,
                 role="user",
                 content=last_user_message
             )
 
             # Run the agent
-            run = self.project.agents.runs.create_and_process(
-                thread_id=thread.id,
-                agent_id=self.agent.id
+            run = await asyncio.get_running_loop().run_in_executor(
+                self.run_executor,
+                functools.partial(
+                    self.project.agents.runs.create_and_process,
+                    thread_id=thread_id,
+                    agent_id=self.agent.id
+                )
             )
 
             logger.info(f"Run completed with status: {run.status}")
 
             if run.status == "failed":
                 logger.error(f"Run failed: {run.last_error}")
-                raise HTTPException(status_code=500, detail=f"Agent run failed: {run.last_error}")
-
-            # Get all messages from the thread
-            messages_pager = self.project.agents.messages.list(
-                thread_id=thread.id,
-                order=ListSortOrder.ASCENDING
-            )
-
-            # Convert ItemPaged to list
-            messages = list(messages_pager)
-            logger.info(f"Retrieved {len(messages)} messages from thread")
-
-            # Find the assistant's response
-            assistant_response = None
-            assistant_messages = []
-
-            for message in messages:
-                if message.role == "assistant":
-                    # Try to extract content from text_messages
-                    if hasattr(message, 'text_messages') and message.text_messages:
-                        for text_msg in message.text_messages:
-                            if hasattr(text_msg, 'text') and text_msg.text:
-                                if hasattr(text_msg.text, 'value'):
-                                    assistant_messages.append(text_msg.text.value)
-                                elif hasattr(text_msg.text, 'content'):
-                                    assistant_messages.append(text_msg.text.content)
-                            elif hasattr(text_msg, 'content'):
-                                assistant_messages.append(text_msg.content)
-
-            # Combine all assistant messages
-            if assistant_messages:
-                assistant_response = "\n".join(assistant_messages)
-            else:
-                logger.warning("No assistant response found, using fallback")
-                assistant_response = "I apologize, but I couldn't generate a proper response. Please try again."
-
-            # Calculate token usage (approximate)
-            prompt_tokens = len(last_user_message.split()) if last_user_message else 0
-            completion_tokens = len(assistant_response.split()) if assistant_response else 0
-            total_tokens = prompt_tokens + completion_tokens
-
-            # Create the response
-            response = ChatCompletionResponse(
-                id=f"chatcmpl-{uuid.uuid4().hex[:29]}",
-                created=int(datetime.now().timestamp()),
-                model=request.model,
-                choices=[
-                    Choice(
-                        index=0,
-                        message=Message(role="assistant", content=assistant_response),
-                        finish_reason="stop"
-                    )
-                ],
-                usage=Usage(
-                    prompt_tokens=prompt_tokens,
-                    completion_tokens=completion_tokens,
-                    total_tokens=total_tokens
+                # Handled by the endpoint's upstream-failure path (audit + 502)
+                raise RuntimeError(f"Agent run failed: {run.last_error}")
+
+            # Fetch only the newest message of this run instead of paging through
+            # the whole thread history; iterating ItemPaged performs network I/O,
+            # so the lookup runs in the worker thread too
+            message = await asyncio.to_thread(self.get_last_assistant_message, thread_id, run.id)
+
+        # Extract the assistant's response
+        assistant_response = None
+        assistant_messages = []
+
+        if message is not None:
+            # Try to extract content from text_messages
+            if hasattr(message, 'text_messages') and message.text_messages:
+                for text_msg in message.text_messages:
+                    if hasattr(text_msg, 'text') and text_msg.text:
+                        if hasattr(text_msg.text, 'value'):
+                            assistant_messages.append(text_msg.text.value)
+                        elif hasattr(text_msg.text, 'content'):
+                            assistant_messages.append(text_msg.text.content)
+                    elif hasattr(text_msg, 'content'):
+                        assistant_messages.append(text_msg.content)
+
+        # Combine all assistant messages
+        if assistant_messages:
+            assistant_response = "\n".join(assistant_messages)
+        else:
+            logger.warning("No assistant response found, using fallback")
+            assistant_response = "I apologize, but I couldn't generate a proper response. Please try again."
+
+        # Calculate token usage (approximate)
+        prompt_tokens = count_tokens(last_user_message)
+        completion_tokens = count_tokens(assistant_response)
+        total_tokens = prompt_tokens + completion_tokens
+
+        # Create the response
+        response = ChatCompletionResponse(
+            id=f"chatcmpl-{uuid.uuid4().hex[:29]}",
+            created=int(time.time()),
+            model=request.model,
+            choices=[
+                Choice(
+                    index=0,
+                    message=Message(role="assistant", content=assistant_response),
+                    finish_reason="stop"
                 )
+            ],
+            usage=Usage(
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                total_tokens=total_tokens
             )
+        )
 
-            logger.info("Response created successfully")
-            return response
-
-        except HTTPException:
-            raise
-        except Exception as e:
-            logger.error(f"Unexpected error in chat completion: {str(e)}")
-            # Return a valid response even on error to prevent client-side crashes
-            return ChatCompletionResponse(
-                id=f"chatcmpl-error-{uuid.uuid4().hex[:20]}",
-                created=int(datetime.now().timestamp()),
-                model=request.model,
-                choices=[
-                    Choice(
-                        index=0,
-                        message=Message(role="assistant", content=f"I apologize, but an error occurred: {str(e)}"),
-                        finish_reason="stop"
-                    )
-                ],
-                usage=Usage(
-                    prompt_tokens=0,
-                    completion_tokens=10,
-                    total_tokens=10
-                )
-            )
+        logger.info("Response created successfully")
+        return response
 
 adapter = None
+audit_task = None
 
 @app.on_event("startup")
 async def startup_event():
-    global adapter
+    global adapter, audit_task
+    audit_task = asyncio.create_task(audit_writer())
+    await asyncio.to_thread(load_token_encoding)
     adapter = FoundryAgentAdapter()
     logger.info("Foundry Agent adapter initialized")
 
-@app.post("/v1/chat/completions")
-async def create_chat_completion(request: ChatCompletionRequest):
+@app.on_event("shutdown")
+async def shutdown_event():
+    if adapter:
+        adapter.run_executor.shutdown(wait=False, cancel_futures=True)
+
+    # Flush pending audit records before stopping the writer
+    if audit_task:
+        await audit_queue.join()
+        audit_task.cancel()
+
+def inline_schema_refs(schema: dict) -> dict:
+    """Inline local $defs references so a model schema can be embedded in openapi.json"""
+    defs = schema.pop("$defs", {})
+
+    def resolve(node):
+        if isinstance(node, dict):
+            ref = node.get("$ref")
+            if ref and ref.startswith("#/$defs/"):
+                return resolve(defs[ref.rsplit("/", 1)[-1]])
+            return {key: resolve(value) for key, value in node.items()}
+        if isinstance(node, list):
+            return [resolve(value) for value in node]
+        return node
+
+    return resolve(schema)
+
+def validate_body_like_fastapi(body: bytes) -> ChatCompletionRequest:
+    """Parse and validate a body the way FastAPI does, raising its 422 error shapes"""
+    if not body:
+        raise RequestValidationError(
+            [{"type": "missing", "loc": ("body",), "msg": "Field required", "input": None}],
+            body=None
+        )
+    try:
+        parsed = json.loads(body)
+    except json.JSONDecodeError as e:
+        raise RequestValidationError(
+            [{"type": "json_invalid", "loc": ("body", e.pos), "msg": "JSON decode error", "input": {}, "ctx": {"error": e.msg}}],
+            body=e.doc
+        ) from e
+    try:
+        return REQUEST_ADAPTER.validate_python(parsed)
+    except ValidationError as e:
+        errors = [{**error, "loc": ("body", *error["loc"])} for error in e.errors(include_url=False)]
+        raise RequestValidationError(errors, body=parsed) from e
+
+# The route reads the raw body itself, so its request schema is declared explicitly
+CHAT_COMPLETION_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "application/json": {"schema": inline_schema_refs(ChatCompletionRequest.model_json_schema())}
+        }
+    }
+}
+
+@app.post("/v1/chat/completions", openapi_extra=CHAT_COMPLETION_OPENAPI)
+async def create_chat_completion(http_request: Request):
     if not adapter:
         raise HTTPException(status_code=500, detail="Adapter not initialized")
 
+    # Validate straight from the raw body in one pass; the original bytes are
+    # kept for the audit trail instead of dumping the parsed model again
+    request_body = await http_request.body()
+    try:
+        request = REQUEST_ADAPTER.validate_json(request_body)
+    except ValidationError:
+        # Invalid input only: redo FastAPI's own parsing so the 422 matches it exactly
+        request = validate_body_like_fastapi(request_body)
+    x_session_id = http_request.headers.get("x-session-id")
+
     # Check if streaming is requested
     if request.stream:
         logger.info("Streaming response requested")
-        
-        # Convert request to dict for audit
-        request_dict = request.model_dump()
-
-        headers = {
-            "Content-Type": "text/event-stream",
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "Access-Control-Allow-Origin": "*",
-            "Access-Control-Allow-Headers": "*",
-            "Access-Control-Allow-Methods": "*",
-        }
 
         # Create a wrapper generator to collect streaming data for audit
         async def streaming_with_audit():
-            collected_chunks = []
-            collected_content = ""
+            # Track the emitted stream by count, size and digest rather than
+            # keeping every frame in memory
+            chunk_count = 0
+            total_bytes = 0
+            digest = hashlib.sha256()
+            collected_content = []
             
             try:
-                async for chunk in adapter.create_streaming_response(request):
-                    collected_chunks.append(chunk)
-                    
-                    # Extract content from chunk for audit
-                    if chunk.startswith("data: ") and not chunk.startswith("data: [DONE]"):
-                        try:
-                            chunk_data = chunk[6:].strip()  # Remove "data: " prefix
-                            if chunk_data:
-                                chunk_json = json.loads(chunk_data)
-                                if "choices" in chunk_json and chunk_json["choices"]:
-                                    delta = chunk_json["choices"][0].get("delta", {})
-                                    if "content" in delta and delta["content"]:
-                                        collected_content += delta["content"]
-                        except json.JSONDecodeError:
-                            pass  # Skip malformed chunks
-                    
-                    yield chunk
+                async with aclosing(adapter.create_streaming_response(request, x_session_id)) as events:
+                    async for event_type, payload in events:
+                        if event_type == "done":
+                            chunk = SSE_DONE
+                        else:
+                            # Collect content for audit straight from the payload, then
+                            # serialize it exactly once for the wire
+                            content = payload["choices"][0]["delta"].get("content")
+                            if content:
+                                collected_content.append(content)
+                            chunk = SSE_PREFIX + orjson.dumps(payload) + SSE_SUFFIX
+
+                        chunk_count += 1
+                        total_bytes += len(chunk)
+                        digest.update(chunk)
+                        yield chunk
                 
                 # Save audit data after streaming completes
                 streaming_audit_data = {
-                    "chunks": collected_chunks,
-                    "full_content": collected_content,
-                    "chunk_count": len(collected_chunks)
+                    "chunk_count": chunk_count,
+                    "bytes": total_bytes,
+                    "sha256": digest.hexdigest(),
+                    "full_content": "".join(collected_content)
                 }
-                save_audit_data(request_dict, streaming_audit_data, "chat_completion_streaming")
+                save_audit_data(request_body, streaming_audit_data, "chat_completion_streaming")
                 
             except Exception as e:
                 logger.error(f"Error in streaming audit: {e}")
                 # Save error audit data
                 error_audit_data = {
                     "error": str(e),
-                    "chunks_before_error": collected_chunks
+                    "chunk_count": chunk_count,
+                    "bytes": total_bytes,
+                    "sha256": digest.hexdigest(),
+                    "content_before_error": "".join(collected_content)
                 }
-                save_audit_data(request_dict, error_audit_data, "chat_completion_streaming_error")
+                save_audit_data(request_body, error_audit_data, "chat_completion_streaming_error")
                 raise
 
         return StreamingResponse(
             streaming_with_audit(),
             media_type="text/event-stream",
-            headers=headers
+            headers=STREAM_RESPONSE_HEADERS
         )
 
     # Non-streaming response
     try:
-        # Convert request to dict for audit
-        request_dict = request.model_dump()
-        
-        response = await adapter.create_chat_completion(request)
+        response = await adapter.create_chat_completion(request, x_session_id)
 
         # Basic validation
         if not response.choices or len(response.choices) == 0:
@@ -506,23 +865,19 @@ async def create_chat_completion(request: ChatCompletionRequest):
 
         logger.info("Returning successful response")
         
-        # Convert response to dict for audit
-        response_dict = response.model_dump()
+        # Serialize the response once; the same bytes go to the client and the audit
+        response_json = RESPONSE_ADAPTER.dump_json(response)
         
         # Save audit data
-        save_audit_data(request_dict, response_dict, "chat_completion_non_streaming")
+        save_audit_data(request_body, response_json, "chat_completion_non_streaming")
 
         # Return with OpenAI-compatible headers
-        headers = {
-            "Content-Type": "application/json",
-            "openai-version": "2020-10-01",
-            "openai-model": response.model,
-            "x-request-id": response.id,
-        }
+        headers = {**BASE_RESPONSE_HEADERS, "openai-model": response.model, "x-request-id": response.id}
 
-        return JSONResponse(
-            content=response_dict,
+        return Response(
+            content=response_json,
             status_code=200,
+            media_type="application/json",
             headers=headers
         )
 
@@ -530,47 +885,16 @@ async def create_chat_completion(request: ChatCompletionRequest):
         raise
     except Exception as e:
         logger.error(f"Unexpected error in endpoint: {str(e)}")
-        
-        # Convert request to dict for audit
-        request_dict = request.model_dump()
-        
-        # Return a fail-safe response
-        fallback_response = ChatCompletionResponse(
-            id=f"chatcmpl-failsafe-{uuid.uuid4().hex[:20]}",
-            created=int(datetime.now().timestamp()),
-            model=request.model,
-            choices=[
-                Choice(
-                    index=0,
-                    message=Message(role="assistant", content="I apologize, but I encountered an error processing your request. Please try again."),
-                    finish_reason="stop"
-                )
-            ],
-            usage=Usage(
-                prompt_tokens=10,
-                completion_tokens=20,
-                total_tokens=30
-            )
-        )
-        
-        # Convert response to dict for audit
-        response_dict = fallback_response.model_dump()
-        response_dict["error"] = str(e)  # Add error info to audit
-        
-        # Save audit data for error case
-        save_audit_data(request_dict, response_dict, "chat_completion_error")
-
-        headers = {
-            "Content-Type": "application/json",
-            "openai-version": "2020-10-01",
-            "openai-model": request.model,
-            "x-request-id": fallback_response.id
-        }
+        request_id = f"chatcmpl-error-{uuid.uuid4().hex[:20]}"
 
-        return JSONResponse(
-            content=fallback_response.model_dump(),
-            status_code=200,
-            headers=headers
+        # Record a small error entry on the background audit queue, then fail fast
+        # with a 5xx so clients can apply their own retry/backoff
+        save_audit_data(request_body, {"error": str(e), "request_id": request_id}, "chat_completion_error")
+
+        raise HTTPException(
+            status_code=502,
+            detail="upstream agent failed",
+            headers={"x-request-id": request_id}
         )
 
 @app.get("/v1/models")
@@ -581,7 +905,7 @@ async def list_models():
             {
                 "id": "gpt-4o-enterprise",
                 "object": "model",
-                "created": int(datetime.now().timestamp()),
+                "created": int(time.time()),
                 "owned_by": "foundry"
             }
         ]